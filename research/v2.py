@@ -1,154 +1,69 @@
 #!/usr/bin/env python3
 """
 v2.py - Voice / Music / Background / Wind volume controller
-Usage: python v2.py input_video.mp4 [output.mp4]
+Usage: python v2.py input_video.mp4 [output.mp4] [--voice 100] [--music 100]
+                    [--background 100] [--wind 0] [--device cpu] [--quality]
 
 Demucs 4-stem separation:
   Voice      = vocals
   Music      = drums + bass
   Background = other (ambient, sfx, misc)
-  Wind       = ffmpeg afftdn denoiser applied to the other stem
+  Wind       = spectral denoiser applied to the other stem
+
+Thin CLI over src/separator.py; everything runs in-process.
 """
-import os, sys, subprocess, shutil, tempfile
+import argparse, os, shutil, sys, tempfile
 from pathlib import Path
 
-import numpy as np
-import soundfile as sf
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
 
+from src.separator import mix_and_export, mux_video, run_demucs
 
-def ffmpeg(*args):
-    r = subprocess.run(["ffmpeg", "-y", *args], capture_output=True, text=True)
-    if r.returncode != 0:
-        print(r.stderr[-2000:])
-        sys.exit(1)
 
+def percent(lo, hi):
+    def parse(raw):
+        v = float(raw)
+        if not lo <= v <= hi:
+            raise argparse.ArgumentTypeError(f"enter {lo}-{hi}")
+        return v
+    return parse
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python v2.py input.mp4 [output.mp4]")
-        sys.exit(1)
 
-    input_path = os.path.abspath(sys.argv[1])
-    output_path = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else \
+def main():
+    parser = argparse.ArgumentParser(description="Remix the audio of a video by stem.")
+    parser.add_argument("input")
+    parser.add_argument("output", nargs="?")
+    parser.add_argument("--voice", type=percent(0, 200), default=100, help="volume %% (0-200)")
+    parser.add_argument("--music", type=percent(0, 200), default=100, help="volume %% (0-200)")
+    parser.add_argument("--background", type=percent(0, 200), default=100, help="volume %% (0-200)")
+    parser.add_argument("--wind", type=percent(0, 100), default=0, help="reduction %% (0-100)")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--quality", action="store_true",
+                        help="slower separation with a random-shift pass and 25%% overlap")
+    args = parser.parse_args()
+
+    input_path = os.path.abspath(args.input)
+    output_path = os.path.abspath(args.output) if args.output else \
         str(Path(input_path).with_stem(Path(input_path).stem + "_mixed"))
 
     tmp = tempfile.mkdtemp(prefix="v2_")
     try:
-        # 1. Extract audio
-        print("Extracting audio...")
-        wav = os.path.join(tmp, "audio.wav")
-        ffmpeg("-i", input_path, "-vn", "-acodec", "pcm_s16le", "-ar", "44100", "-ac", "2", wav)
-
-        # 2. Demucs 4-stem separation
+        # 1. Demucs 4-stem separation (audio is decoded straight from the input)
         print("Separating stems (Demucs 4-stem)...")
-        proc = subprocess.Popen(
-            [sys.executable, "-m", "demucs",
-             "--name", "htdemucs", "--out", tmp, wav],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-            text=True, encoding="utf-8", errors="replace"
-        )
-        for line in proc.stdout:
-            line = line.strip()
-            if line:
-                print(f"  {line}")
-        proc.wait()
-        if proc.returncode != 0:
-            print("Demucs failed")
-            sys.exit(1)
-
-        stem = Path(wav).stem
-        base = os.path.join(tmp, "htdemucs", stem)
-        stems = {
-            "vocals": os.path.join(base, "vocals.wav"),
-            "drums":  os.path.join(base, "drums.wav"),
-            "bass":   os.path.join(base, "bass.wav"),
-            "other":  os.path.join(base, "other.wav"),
-        }
-
-        for name, path in stems.items():
-            if not os.path.exists(path):
-                print(f"Not found: {path}")
-                sys.exit(1)
-
-        # Show info
-        dur = sf.info(stems["vocals"]).duration
-        print(f"\nDuration: {dur:.1f}s")
-        print("  Voice      = vocals")
-        print("  Music      = drums + bass")
-        print("  Background = other (wind lives here)\n")
-
-        # 3. Ask volumes
-        def ask(label, default=100):
-            while True:
-                raw = input(f"{label} volume % [{default}]: ").strip()
-                if raw == "": return default / 100.0
-                try:
-                    v = float(raw)
-                    if 0 <= v <= 200: return v / 100.0
-                except ValueError:
-                    pass
-                print("  Enter 0-200")
-
-        def ask_reduction(label):
-            while True:
-                raw = input(f"{label} reduction % [0]: ").strip()
-                if raw == "": return 0.0
-                try:
-                    v = float(raw)
-                    if 0 <= v <= 100: return v
-                except ValueError:
-                    pass
-                print("  Enter 0-100")
-
-        voice_vol  = ask("Voice")
-        music_vol  = ask("Music")
-        bg_vol     = ask("Background")
-        wind_red   = ask_reduction("Wind")   # 0 = off, 100 = max reduction
-
-        # Apply wind reduction to the other stem via ffmpeg afftdn
-        other_stem = stems["other"]
-        if wind_red > 0:
-            print(f"\nApplying wind reduction ({wind_red:.0f}%)...")
-            nr_val = wind_red * 0.97          # map 0-100 → 0-97 dB (afftdn max)
-            cleaned = os.path.join(tmp, "other_clean.wav")
-            ffmpeg("-i", other_stem,
-                   "-af", f"afftdn=nr={nr_val:.1f}:nf=-25",
-                   cleaned)
-            other_stem = cleaned
-
-        # 4. Mix
-        print("\nMixing...")
-        def load(path):
-            data, sr = sf.read(path, dtype="float32")
-            return data, sr
-
-        v_data,  sr = load(stems["vocals"])
-        dr_data, _  = load(stems["drums"])
-        ba_data, _  = load(stems["bass"])
-        ot_data, _  = load(other_stem)
-
-        n = min(len(v_data), len(dr_data), len(ba_data), len(ot_data))
-        mixed = (
-            v_data[:n]  * voice_vol +
-            dr_data[:n] * music_vol +
-            ba_data[:n] * music_vol +
-            ot_data[:n] * bg_vol
-        )
-
-        peak = np.max(np.abs(mixed))
-        if peak > 1.0:
-            mixed /= peak
+        stems = run_demucs(input_path, tmp, args.device,
+                           lambda pct, msg: print(f"\r  {msg}", end="", flush=True),
+                           fast_mode=not args.quality)
+        print()
 
+        # 2. Mix
+        print("Mixing...")
         mixed_wav = os.path.join(tmp, "mixed.wav")
-        sf.write(mixed_wav, mixed, sr)
+        mix_and_export(stems, args.voice / 100, args.music / 100,
+                       args.background / 100, args.wind, mixed_wav)
 
-        # 5. Mux back to video
+        # 3. Mux back to video
         print("Muxing video...")
-        ffmpeg(
-            "-i", input_path, "-i", mixed_wav,
-            "-c:v", "copy", "-map", "0:v:0", "-map", "1:a:0",
-            "-shortest", output_path
-        )
+        mux_video(input_path, mixed_wav, output_path)
 
         print(f"\nDone: {output_path}")
 
@@ -1,23 +1,105 @@
 #!/usr/bin/env python3
 """FastAPI web app for voice/music/background/wind audio mixer."""
-import asyncio, json, os, uuid
-from concurrent.futures import ThreadPoolExecutor
+import asyncio, json, logging, multiprocessing, os, uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
 
+import aiofiles
+import numpy as np
 from fastapi import FastAPI, File, HTTPException, UploadFile
 from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
 
+from .separator import init_worker, load_stems, make_mixer, separate_job, warm_model
+
+# Seconds between status events when a job has no progress to report.
+HEARTBEAT_S = 5
+
+VIDEO_EXTS = {".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".m4v", ".ts", ".mpg"}
+
+# Device whose model each worker loads when the pool starts (see _warm_workers),
+# so jobs start warm.
+DEFAULT_DEVICE = os.environ.get("DEMUCS_DEVICE", "cpu")
+
+# Jobs whose stems stay in memory for previews; older ones reload from disk.
+# At least one: the job being previewed has to stay resident while it mixes.
+RESIDENT_JOBS = max(1, int(os.environ.get("RESIDENT_JOBS", 2)))
+
 app = FastAPI(title="Audio Mixer")
 jobs: dict = {}
-executor = ThreadPoolExecutor(max_workers=2)
+# job_id -> None, least recently previewed first
+resident: OrderedDict = OrderedDict()
+
+# Separation runs in worker processes, each holding its own resident model.
+# forkserver keeps CUDA and torch's thread pools out of the parent's fork.
+MAX_WORKERS = 2
+mp_ctx = multiprocessing.get_context("forkserver")
+progress_queue = mp_ctx.Queue()
+
+
+def _make_executor():
+    # Workers split the cores between them rather than oversubscribing.
+    threads = max(1, (os.cpu_count() or 1) // MAX_WORKERS)
+    return ProcessPoolExecutor(
+        max_workers=MAX_WORKERS, mp_context=mp_ctx,
+        initializer=init_worker, initargs=(progress_queue, DEFAULT_DEVICE, threads),
+    )
 
-VIDEO_EXTS = {".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm", ".m4v", ".ts", ".mpg"}
+
+executor = _make_executor()
 
 os.makedirs("jobs", exist_ok=True)
 os.makedirs("static", exist_ok=True)
 
 
+@app.on_event("startup")
+async def start_workers():
+    loop = asyncio.get_running_loop()
+    app.state.drain_task = loop.create_task(_drain_progress())
+    app.state.warm_task = loop.create_task(_warm_workers(executor))
+
+
+@app.on_event("shutdown")
+async def stop_workers():
+    app.state.warm_task.cancel()
+    progress_queue.put(None)
+    await app.state.drain_task
+    executor.shutdown(cancel_futures=True)
+
+
+async def _warm_workers(pool):
+    """
+    Start every worker in pool and load the model in each, so the first jobs
+    don't pay for it. Workers only start on submit, and each submit made while
+    none is idle starts one, so one warm-up per worker starts them all.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[loop.run_in_executor(pool, warm_model, DEFAULT_DEVICE) for _ in range(MAX_WORKERS)],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logging.getLogger(__name__).error(
+                "Could not preload the %s model", DEFAULT_DEVICE, exc_info=result)
+
+
+async def _drain_progress():
+    """Copy worker progress from the queue into jobs and wake status streams."""
+    loop = asyncio.get_running_loop()
+    while (item := await loop.run_in_executor(None, progress_queue.get)) is not None:
+        job_id, pct, msg = item
+        job = jobs.get(job_id)
+        # Updates can trail the job's result; never overwrite ready/error.
+        if job and job["status"] == "processing":
+            job["progress"] = pct
+            job["message"] = msg
+            job["event"].set()
+
+
 @app.get("/")
 async def index():
     return FileResponse("static/index.html")
@@ -31,9 +113,9 @@ async def upload(file: UploadFile = File(...)):
 
     filename = file.filename or "input"
     file_path = os.path.join(job_dir, filename)
-    with open(file_path, "wb") as f:
-        while chunk := await file.read(1 << 20):
-            f.write(chunk)
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await file.read(4 << 20):
+            await f.write(chunk)
 
     jobs[job_id] = {
         "status": "uploaded",
@@ -41,12 +123,15 @@ async def upload(file: UploadFile = File(...)):
         "message": "File uploaded",
         "input_path": file_path,
         "job_dir": job_dir,
+        "event": asyncio.Event(),
+        "lock": asyncio.Lock(),
     }
     return {"job_id": job_id}
 
 
 class ProcessRequest(BaseModel):
-    device: str = "cpu"
+    device:    str  = "cpu"
+    fast_mode: bool = True
 
 
 @app.post("/api/process/{job_id}")
@@ -55,52 +140,76 @@ async def process(job_id: str, body: ProcessRequest):
         raise HTTPException(404, "Job not found")
     job = jobs[job_id]
     job.update({"status": "processing", "progress": 0, "message": "Starting..."})
-
-    def progress_cb(pct, msg):
-        job["progress"] = int(pct)
-        job["message"] = msg
-
-    def run():
+    job["event"].set()
+    # Stems from an earlier run are about to be replaced.
+    resident.pop(job_id, None)
+    for key in ("arrays", "denoise_cache", "mix_buf"):
+        job.pop(key, None)
+
+    async def run():
+        global executor
+        loop = asyncio.get_running_loop()
+        pool = executor
         try:
-            from .separator import extract_audio, run_demucs
-
-            job_dir = job["job_dir"]
-            input_path = job["input_path"]
-            is_video = Path(input_path).suffix.lower() in VIDEO_EXTS
-
-            progress_cb(5, "Extracting audio...")
-            if is_video:
-                wav = os.path.join(job_dir, "audio.wav")
-                extract_audio(input_path, wav)
-            else:
-                wav = input_path
-
-            progress_cb(10, "Separating stems — this may take a few minutes...")
-            stems = run_demucs(
-                wav, job_dir, body.device,
-                lambda p, m: progress_cb(10 + int(p * 0.88), m),
+            stems = await loop.run_in_executor(
+                pool, separate_job,
+                job_id, job["input_path"], job["job_dir"], body.device, body.fast_mode,
             )
-
             job["stems"] = stems
+            async with job["lock"]:
+                await _make_resident(job_id)
+                channels = job["mix_buf"].shape[1]
+            job["mixer"] = await loop.run_in_executor(None, make_mixer, channels)
             job["duration_s"] = round(__import__("soundfile").info(stems["vocals"]).duration, 1)
-            job["status"] = "ready"
-            progress_cb(100, "Ready")
+            job.update({"status": "ready", "progress": 100, "message": "Ready"})
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory) and took the pool with it;
+            # start and warm a fresh one unless another job already has.
+            if executor is pool:
+                executor = _make_executor()
+                pool.shutdown(wait=False)
+                app.state.warm_task = loop.create_task(_warm_workers(executor))
+            job["status"] = "error"
+            job["message"] = "Separation worker crashed — please try again"
         except Exception as e:
             job["status"] = "error"
             job["message"] = str(e)
+        job["event"].set()
 
-    executor.submit(run)
+    job["task"] = asyncio.create_task(run())
     return {"status": "processing"}
 
 
+async def _make_resident(job_id):
+    """
+    Make sure a job's stems, denoise cache and mix buffer are in memory and
+    mark it most recently used, releasing those of the least recently used
+    jobs beyond RESIDENT_JOBS. Call with the job's lock held.
+    """
+    job = jobs[job_id]
+    if "arrays" not in job:
+        arrays = await asyncio.get_running_loop().run_in_executor(None, load_stems, job["stems"])
+        frames = min(len(a) for a in arrays.values())
+        job["mix_buf"] = np.empty((frames, arrays["vocals"].shape[1]), dtype=np.float32)
+        job["denoise_cache"] = {}
+        job["arrays"] = arrays
+    resident[job_id] = None
+    resident.move_to_end(job_id)
+    while len(resident) > RESIDENT_JOBS:
+        # A preview already running on an evicted job keeps its own references.
+        old = jobs.get(resident.popitem(last=False)[0], {})
+        for key in ("arrays", "denoise_cache", "mix_buf"):
+            old.pop(key, None)
+
+
 @app.get("/api/status/{job_id}")
 async def get_status(job_id: str):
     async def gen():
+        job = jobs.get(job_id)
+        if not job:
+            yield f"data: {json.dumps({'error': 'not found'})}\n\n"
+            return
         while True:
-            job = jobs.get(job_id)
-            if not job:
-                yield f"data: {json.dumps({'error': 'not found'})}\n\n"
-                break
             payload = json.dumps({
                 "status":     job["status"],
                 "progress":   job.get("progress", 0),
@@ -110,7 +219,12 @@ async def get_status(job_id: str):
             yield f"data: {payload}\n\n"
             if job["status"] in ("ready", "error"):
                 break
-            await asyncio.sleep(0.5)
+            # Wake on the next update; on timeout re-send the state as a heartbeat.
+            try:
+                await asyncio.wait_for(job["event"].wait(), timeout=HEARTBEAT_S)
+                job["event"].clear()
+            except asyncio.TimeoutError:
+                pass
 
     return StreamingResponse(gen(), media_type="text/event-stream", headers={
         "Cache-Control": "no-cache",
@@ -141,15 +255,23 @@ async def preview(job_id: str, body: PreviewRequest):
     is_video   = Path(input_path).suffix.lower() in VIDEO_EXTS
 
     mixed_wav = os.path.join(job_dir, "preview.wav")
-    mix_and_export(
-        job["stems"],
-        body.voice          / 100,
-        body.music          / 100,
-        body.background     / 100,
-        body.wind_reduction,
-        mixed_wav,
-        job_dir,
-    )
+    # The mix (and a first-time denoise) takes seconds; run it off the event
+    # loop, one preview per job at a time since they share the job's buffers.
+    async with job["lock"]:
+        await _make_resident(job_id)
+        await asyncio.get_running_loop().run_in_executor(None, partial(
+            mix_and_export,
+            job["stems"],
+            body.voice          / 100,
+            body.music          / 100,
+            body.background     / 100,
+            body.wind_reduction,
+            mixed_wav,
+            arrays=job["arrays"],
+            denoise_cache=job["denoise_cache"],
+            mixer=job["mixer"],
+            out=job["mix_buf"],
+        ))
 
     job["mixed_wav"] = mixed_wav
     return {"preview_url": f"/api/audio/{job_id}/preview.wav"}
@@ -183,9 +305,11 @@ async def download(job_id: str):
         from .separator import mux_video
         out = os.path.join(job["job_dir"], "output.mp4")
         mux_video(input_path, mixed_wav, out)
-        return FileResponse(out, media_type="video/mp4", filename="output.mp4")
+        return FileResponse(out, media_type="video/mp4", filename="output.mp4",
+                            stat_result=os.stat(out))
     else:
-        return FileResponse(mixed_wav, media_type="audio/wav", filename="output.wav")
+        return FileResponse(mixed_wav, media_type="audio/wav", filename="output.wav",
+                            stat_result=os.stat(mixed_wav))
 
 
 if __name__ == "__main__":
@@ -1,10 +1,31 @@
 #!/usr/bin/env python3
 """Core audio separation logic used by the web app."""
-import os, sys, subprocess
+import logging, os, random, subprocess, tempfile, threading
+from collections import deque
+from contextlib import ExitStack
 from pathlib import Path
 
 import numpy as np
 import soundfile as sf
+from numba import njit, prange
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft as sp_fft
+
+STEMS = ("vocals", "drums", "bass", "other")
+
+# Frames per block when streaming stems through the mixer.
+BLOCK_FRAMES = 65536
+
+# STFT frame size and hop for the background denoiser (75% overlap).
+STFT_SIZE = 2048
+STFT_HOP = 512
+_STFT_WINDOW = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(STFT_SIZE) / STFT_SIZE)).astype(np.float32)
+
+# Denoised backgrounds kept per job; oldest strength is evicted first.
+DENOISE_CACHE_SIZE = 4
+
+# Output containers mux_video writes AAC + faststart into.
+MP4_EXTS = {".mp4", ".mov", ".m4v"}
 
 
 def _ffmpeg(*args):
@@ -13,105 +34,569 @@ def _ffmpeg(*args):
         raise RuntimeError(r.stderr[-2000:])
 
 
-def extract_audio(video_path, out_wav):
-    _ffmpeg("-i", video_path, "-vn", "-acodec", "pcm_s16le",
-            "-ar", "44100", "-ac", "2", out_wav)
+def read_audio(path, samplerate=44100, channels=2):
+    """Decode any ffmpeg-readable file straight into a (channels, frames) float32 array."""
+    # stderr goes to a file: a pipe nobody drains while we read stdout would
+    # stall ffmpeg (and us) once a corrupt input fills it with errors.
+    with tempfile.TemporaryFile() as err:
+        p = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", path, "-vn", "-f", "f32le",
+             "-ac", str(channels), "-ar", str(samplerate), "-"],
+            stdout=subprocess.PIPE, stderr=err,
+        )
+        chunks = []
+        try:
+            while chunk := p.stdout.read(4 << 20):
+                chunks.append(np.frombuffer(chunk, dtype="<f4"))
+        except BaseException:
+            p.kill()
+            raise
+        finally:
+            p.stdout.close()
+            returncode = p.wait()
+        if returncode != 0:
+            err.seek(0)
+            raise RuntimeError(err.read().decode("utf-8", "replace")[-2000:])
+    if not chunks:
+        raise RuntimeError(f"No audio decoded from {path}")
+    return np.ascontiguousarray(np.concatenate(chunks).reshape(-1, channels).T)
+
+
+# Rough peak CUDA memory per htdemucs segment in a batch, for sizing batches.
+_CUDA_BYTES_PER_SEGMENT = 1 << 30
+
+_MODEL_CACHE: dict = {}
+_MODEL_LOCK = threading.Lock()
+
+# Intra-op threads for CPU inference; set per worker by init_worker so pooled
+# workers share the cores instead of each claiming all of them.
+_num_threads = None
+
+
+def _get_model(device):
+    """Load htdemucs once per device and keep it resident."""
+    with _MODEL_LOCK:
+        if device not in _MODEL_CACHE:
+            from demucs.pretrained import get_model
+            import torch
+            model = get_model("htdemucs").to(device).eval()
+            if device == "cpu":
+                torch.set_num_threads(_num_threads or os.cpu_count())
+                torch.backends.mkldnn.enabled = True
+                # int8 weights for the transformer/LSTM layers; convs stay FP32.
+                model = torch.ao.quantization.quantize_dynamic(
+                    model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8)
+            elif device.startswith("cuda"):
+                # Compile the inner networks; the bag itself is just a container.
+                for i, sub in enumerate(model.models):
+                    model.models[i] = torch.compile(
+                        sub, mode="reduce-overhead", fullgraph=False)
+            _MODEL_CACHE[device] = model
+        return _MODEL_CACHE[device]
+
+
+def _default_batch_size(device):
+    """
+    Segments per batch: one at a time off CUDA, like the demucs CLI, since each
+    segment costs several hundred MB of activations; on CUDA, as many as the
+    free device memory allows, up to 8.
+    """
+    import torch
+
+    if device.type != "cuda":
+        return 1
+    free, _ = torch.cuda.mem_get_info(device)
+    return int(max(1, min(8, free // _CUDA_BYTES_PER_SEGMENT)))
+
+
+def apply_vectorized(model, mix, overlap=0.25, batch_size=None, callback=None):
+    """
+    Overlap-add inference over mix (channels, length), running the
+    overlapping segments through the model as stacked (B, C, T) batches.
+    batch_size defaults to _default_batch_size for the model's device.
+    callback, like demucs' apply_model hook, gets {"state": done, "total": n}
+    once per segment. Returns a (sources, channels, length) tensor on the CPU.
+    """
+    import torch as th
+    import torch.nn.functional as F
+    from demucs.apply import BagOfModels
+
+    if isinstance(model, BagOfModels):
+        out, total = 0, 0
+        for sub, w in zip(model.models, model.weights):
+            w = th.tensor(w)[:, None, None]
+            out = out + apply_vectorized(sub, mix, overlap, batch_size, callback) * w
+            total = total + w
+        return out / total
+
+    device = next(model.parameters()).device
+    cuda = device.type == "cuda"
+    batch_size = batch_size or _default_batch_size(device)
+    length = mix.shape[-1]
+    segment = int(model.samplerate * model.segment)
+    stride = int((1 - overlap) * segment)
+    offsets = range(0, length, stride)
+
+    # As in apply_model, a short final chunk is centred in a full segment with
+    # real context on its left, and only its own span of the output is kept;
+    # zeros stand in only past either end of the mix.
+    padded = F.pad(mix, (segment, segment))
+    if cuda:
+        padded = padded.pin_memory()
+    padded = padded.to(device, non_blocking=cuda)
+    # Peak-normalized so the FP16 accumulator on CUDA stays well inside its range;
+    # the weight sum stays FP32.
+    weight = (th.cat([th.arange(1, segment // 2 + 1),
+                      th.arange(segment - segment // 2, 0, -1)]).float()
+              / (segment // 2)).to(device)
+    out = th.zeros(len(model.sources), mix.shape[0], length,
+                   dtype=th.float16 if cuda else th.float32, device=device)
+    sum_weight = th.zeros(length, device=device)
+
+    if cuda:
+        # Samples before the next batch's first offset are final; copy them to
+        # pinned host memory on a side stream while the next batch runs.
+        result = th.empty(len(model.sources), mix.shape[0], length, pin_memory=True)
+        copy_stream = th.cuda.Stream(device)
+        flushed = 0
+
+    for i in range(0, len(offsets), batch_size):
+        chunk = offsets[i:i + batch_size]
+        # Left trim of each segment's output: half the padding of a short chunk.
+        trims = [(segment - min(segment, length - o)) // 2 for o in chunk]
+        batch = th.stack([padded[:, segment + o - t:2 * segment + o - t]
+                          for o, t in zip(chunk, trims)])
+        # FP32 weights stay the master copy; autocast down-casts per op.
+        with th.inference_mode(), th.autocast(device_type="cuda", dtype=th.float16,
+                                              enabled=cuda):
+            y = model(batch).float()
+        for j, (o, t, est) in enumerate(zip(chunk, trims, y)):
+            n = min(segment, length - o)
+            out[..., o:o + n] += (weight[:n] * est[..., t:t + n]).to(out.dtype)
+            sum_weight[o:o + n] += weight[:n]
+            if callback:
+                callback({"state": i + j + 1, "total": len(offsets)})
+
+        if cuda:
+            ready = offsets[i + batch_size] if i + batch_size < len(offsets) else length
+            span = out[..., flushed:ready].float() / sum_weight[flushed:ready]
+            copy_stream.wait_stream(th.cuda.current_stream(device))
+            with th.cuda.stream(copy_stream):
+                result[..., flushed:ready].copy_(span, non_blocking=True)
+            span.record_stream(copy_stream)
+            flushed = ready
 
+    if cuda:
+        copy_stream.synchronize()
+        return result
+    return (out / sum_weight).cpu()
+
+
+def infer_demucs(wav, device="cpu", progress_cb=None, fast_mode=True, batch_size=None):
+    """
+    Separate wav, a (channels, length) tensor at the model's sample rate.
+    fast_mode skips the random-shift pass and uses 10% segment overlap;
+    otherwise the demucs CLI defaults apply (one shift, 25% overlap).
+    batch_size: segments per forward pass (see apply_vectorized).
+    Returns ({stem name: (frames, channels) float32 array}, samplerate).
+    """
+    import torch.nn.functional as F
+
+    model = _get_model(device)
+    shifts, overlap = (0, 0.1) if fast_mode else (1, 0.25)
+
+    # Same normalization demucs applies before separation; the epsilon keeps
+    # silent or DC-only input from dividing by zero.
+    ref = wav.mean(0)
+    mean, std = ref.mean(), ref.std() + 1e-8
+    wav = (wav - mean) / std
+
+    def callback(d, shift=0):
+        if progress_cb:
+            state, total = shift * d["total"] + d["state"], max(shifts, 1) * d["total"]
+            progress_cb(100 * state / total, f"Separating... segment {state}/{total}")
+
+    if not shifts:
+        sources = apply_vectorized(model, wav, overlap, batch_size, callback)
+    else:
+        # Average passes over randomly time-shifted copies, as apply_model does.
+        length = wav.shape[-1]
+        max_shift = int(0.5 * model.samplerate)
+        padded = F.pad(wav, (max_shift, max_shift))
+        sources = 0
+        for k in range(shifts):
+            offset = random.randint(0, max_shift)
+            shifted = padded[..., offset:offset + length + max_shift]
+            out = apply_vectorized(model, shifted, overlap, batch_size,
+                                   lambda d, k=k: callback(d, k))
+            sources = sources + out[..., max_shift - offset:max_shift - offset + length]
+        sources = sources / shifts
+    sources = sources * std + mean
+
+    arrays = {name: np.ascontiguousarray(source.numpy().T)
+              for name, source in zip(model.sources, sources)}
+    for name in STEMS:
+        if name not in arrays:
+            raise RuntimeError(f"Expected stem not produced: {name}")
+    return arrays, model.samplerate
+
+
+def run_demucs(audio_path, job_dir, device="cpu", progress_cb=None, fast_mode=True,
+               batch_size=None):
+    """Run htdemucs 4-stem in-process on any audio/video file. Returns dict of stem paths."""
+    import torch
 
-def run_demucs(audio_path, job_dir, device="cpu", progress_cb=None):
-    """Run htdemucs 4-stem. Returns dict of stem paths."""
     if progress_cb:
         progress_cb(0, "Starting Demucs...")
 
-    cmd = [
-        sys.executable, "-m", "demucs",
-        "--name", "htdemucs",
-        "--out", job_dir,
-        "--device", device,
-        audio_path,
-    ]
-    proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-        text=True, encoding="utf-8", errors="replace"
-    )
-    lines = []
-    for line in proc.stdout:
-        line = line.strip()
-        if line:
-            lines.append(line)
-            # demucs prints something like "  0%|..." — try to parse a %
-            if "%" in line:
-                try:
-                    pct = float(line.split("%")[0].strip().split()[-1])
-                    if progress_cb:
-                        progress_cb(pct, f"Separating... {pct:.0f}%")
-                except Exception:
-                    pass
-    proc.wait()
-
-    if proc.returncode != 0:
-        raise RuntimeError("Demucs failed:\n" + "\n".join(lines[-20:]))
-
-    stem = Path(audio_path).stem
-    base = os.path.join(job_dir, "htdemucs", stem)
-    stems = {
-        "vocals": os.path.join(base, "vocals.wav"),
-        "drums":  os.path.join(base, "drums.wav"),
-        "bass":   os.path.join(base, "bass.wav"),
-        "other":  os.path.join(base, "other.wav"),
-    }
-    for name, path in stems.items():
-        if not os.path.exists(path):
-            raise RuntimeError(f"Expected stem not found: {path}")
+    model = _get_model(device)
+    wav = torch.from_numpy(read_audio(audio_path, model.samplerate, model.audio_channels))
+    arrays, sr = infer_demucs(wav, device, progress_cb, fast_mode, batch_size)
+
+    base = os.path.join(job_dir, "htdemucs", Path(audio_path).stem)
+    os.makedirs(base, exist_ok=True)
+    stems = {}
+    for name in STEMS:
+        stems[name] = os.path.join(base, f"{name}.wav")
+        sf.write(stems[name], arrays[name], sr, subtype="FLOAT")
 
     if progress_cb:
         progress_cb(100, "Separation complete")
     return stems
 
 
-def mix_and_export(stems, voice_vol, music_vol, bg_vol, wind_red, out_wav, tmp_dir):
+_MIXERS = {}
+_MIXER_SIG = "f8(f4[:, ::1], f4[:, ::1], f4[:, ::1], f4[:, ::1], f4, f4, f4, f4[:, ::1])"
+
+
+def make_mixer(channels=None):
+    """
+    Return the fused gain/sum kernel for one block of stems, which writes the
+    mix into out and returns the block peak. With a channel count the count is
+    a compile-time constant, so the channel loop is fully unrolled; None reads
+    it from the block. The single float32 signature is compiled eagerly, once
+    per channel count.
+    """
+    if channels not in _MIXERS:
+        width = -1 if channels is None else channels
+
+        @njit(_MIXER_SIG, parallel=True, fastmath=True, cache=True)
+        def mixer(v, dr, ba, ot, gv, gm, gb, out):
+            n = v.shape[1] if width < 0 else width
+            peak = 0.0
+            for i in prange(v.shape[0]):
+                for c in range(n):
+                    x = v[i, c] * gv + (dr[i, c] + ba[i, c]) * gm + ot[i, c] * gb
+                    out[i, c] = x
+                    peak = max(peak, abs(x))
+            return peak
+        _MIXERS[channels] = mixer
+    return _MIXERS[channels]
+
+
+# Generic kernel; compiled at import so the first preview request doesn't pay
+# the JIT cost.
+_mix_block = make_mixer()
+
+
+def _stft_frames(blocks):
+    """
+    Cut a stream of (n, channels) float32 blocks into batches of Hann-windowed
+    STFT frames shaped (frames, channels, STFT_SIZE). The signal is treated as
+    zero-padded by STFT_SIZE // 2 on the left and enough on the right for the
+    last frame to end on a hop boundary.
+    """
+    half = STFT_SIZE // 2
+    buf, total = None, 0
+
+    def cut(buf):
+        if len(buf) < STFT_SIZE:
+            return buf[:0, :, None], buf
+        nf = (len(buf) - STFT_SIZE) // STFT_HOP + 1
+        frames = sliding_window_view(buf, STFT_SIZE, axis=0)[::STFT_HOP] * _STFT_WINDOW
+        return frames, buf[nf * STFT_HOP:]
+
+    for block in blocks:
+        if buf is None:
+            buf = np.zeros((half, block.shape[1]), dtype=np.float32)
+        total += len(block)
+        frames, buf = cut(np.concatenate([buf, block]))
+        if len(frames):
+            yield frames
+    if buf is None:
+        return
+    tail = np.zeros((half + -total % STFT_HOP, buf.shape[1]), dtype=np.float32)
+    frames, _ = cut(np.concatenate([buf, tail]))
+    if len(frames):
+        yield frames
+
+
+def noise_profile(src):
+    """
+    Per-channel noise power spectrum (channels, bins) of src, a (frames,
+    channels) array or an audio file path: in each bin, the mean power of the
+    lowest-power 10% of STFT frames, selected in a single block-wise pass.
+    """
+    with ExitStack() as stack:
+        if not isinstance(src, np.ndarray):
+            src = stack.enter_context(sf.SoundFile(src))
+        length = len(src) if isinstance(src, np.ndarray) else src.frames
+        k = max(1, ((length + -length % STFT_HOP) // STFT_HOP + 1) // 10)
+
+        P = None
+        for frames in _stft_frames(_blocks(src)):
+            Z = sp_fft.rfft(frames, axis=-1, workers=-1)
+            p = Z.real ** 2 + Z.imag ** 2                          # (frames, channels, bins)
+            P = p if P is None else np.concatenate([P, p])
+            # Keep candidates bounded: shrink each bin back to its k lowest at 2k.
+            if len(P) >= 2 * k:
+                P = np.partition(P, k - 1, axis=0)[:k]
+        if len(P) > k:
+            P = np.partition(P, k - 1, axis=0)[:k]
+        return P.mean(axis=0)
+
+
+def _denoise_blocks(blocks, noise, strength, floor=0.05):
+    """
+    Spectral noise reduction over a stream of (n, channels) float32 blocks,
+    yielding denoised blocks of the same sizes. Each bin gets a Wiener-style
+    gain against the noise profile, clamped to floor. Frames are gated and
+    overlap-added as input arrives, carrying the unfinished STFT_SIZE - STFT_HOP
+    tail into the next batch.
+    """
+    half, tail = STFT_SIZE // 2, STFT_SIZE - STFT_HOP
+    r = STFT_SIZE // STFT_HOP
+    sizes = deque()
+    acc = norm = pending = None
+    skip = half          # output for the leading zero padding
+
+    def sized(blocks):
+        for block in blocks:
+            sizes.append(len(block))
+            yield block
+
+    def emit(chunk):
+        nonlocal pending, skip
+        drop = min(skip, len(chunk))
+        skip -= drop
+        pending = np.concatenate([pending, chunk[drop:]])
+        while sizes and len(pending) >= sizes[0]:
+            n = sizes.popleft()
+            yield pending[:n]
+            pending = pending[n:]
+
+    for frames in _stft_frames(sized(blocks)):
+        nf, channels = frames.shape[:2]
+        if acc is None:
+            acc = np.zeros((tail, channels), dtype=np.float32)
+            norm = np.zeros(tail, dtype=np.float32)
+            pending = np.zeros((0, channels), dtype=np.float32)
+        Z = sp_fft.rfft(frames, axis=-1, workers=-1)
+        P = Z.real ** 2 + Z.imag ** 2
+        G = np.maximum(1 - strength * noise / (P + 1e-10), floor)
+        y = sp_fft.irfft(Z * G, n=STFT_SIZE, axis=-1, workers=-1) * _STFT_WINDOW
+
+        span = (nf - 1) * STFT_HOP + STFT_SIZE
+        out = np.zeros((span, channels), dtype=np.float32)
+        wsum = np.zeros(span, dtype=np.float32)
+        out[:tail] += acc
+        wsum[:tail] += norm
+        # Every r-th frame tiles the signal without overlap, so each phase
+        # group is added as one contiguous run.
+        for k in range(r):
+            group = y[k::r]
+            run = slice(k * STFT_HOP, k * STFT_HOP + len(group) * STFT_SIZE)
+            out[run] += group.transpose(0, 2, 1).reshape(-1, channels)
+            wsum[run] += np.tile(_STFT_WINDOW ** 2, len(group))
+
+        done = nf * STFT_HOP
+        yield from emit(out[:done] / np.maximum(wsum[:done], 1e-8)[:, None])
+        acc, norm = out[done:], wsum[done:]
+
+    if acc is not None:
+        yield from emit(acc / np.maximum(norm, 1e-8)[:, None])
+
+
+def _collect(blocks, out, filled):
+    """Pass blocks through while copying them into out; filled[0] counts frames copied."""
+    for block in blocks:
+        out[filled[0]:filled[0] + len(block)] = block
+        filled[0] += len(block)
+        yield block
+
+
+def _blocks(src):
+    """
+    Yield float32 blocks from an open SoundFile or an in-memory array; any
+    other iterable is taken to yield blocks already.
+    """
+    if isinstance(src, np.ndarray):
+        for i in range(0, len(src), BLOCK_FRAMES):
+            yield src[i:i + BLOCK_FRAMES].astype(np.float32, copy=False)
+    elif isinstance(src, sf.SoundFile):
+        yield from src.blocks(blocksize=BLOCK_FRAMES, dtype="float32", always_2d=True)
+    else:
+        yield from src
+
+
+_progress_queue = None
+
+
+def init_worker(queue, device, num_threads=None):
+    """
+    Process-pool initializer: keep the progress queue, cap torch's threads at
+    num_threads (all cores if None) and preload the model.
+    """
+    global _progress_queue, _num_threads
+    _progress_queue = queue
+    _num_threads = num_threads
+    # Best effort: an initializer that raises breaks the whole pool, whereas a
+    # load failure here will resurface, with its message, on the first job.
+    try:
+        warm_model(device)
+    except Exception:
+        logging.getLogger(__name__).exception("Could not preload the %s model", device)
+
+
+def warm_model(device):
+    """Load the model for device into this process's cache."""
+    _get_model(device)
+
+
+def separate_job(job_id, input_path, job_dir, device, fast_mode=True):
+    """
+    Worker-side separation for one job. Progress goes to the queue given to
+    init_worker as (job_id, pct, message) tuples. Returns dict of stem paths.
+    """
+    def progress_cb(pct, msg):
+        _progress_queue.put((job_id, int(pct), msg))
+
+    progress_cb(10, "Separating stems — this may take a few minutes...")
+    return run_demucs(
+        input_path, job_dir, device,
+        lambda p, m: progress_cb(10 + int(p * 0.88), m),
+        fast_mode,
+    )
+
+
+def load_stems(stems):
+    """
+    Read every stem into memory as a (frames, channels) float16 array. Half
+    precision halves resident size and mix bandwidth; blocks are widened to
+    float32 before mixing, so accumulation keeps full precision.
+    """
+    return {name: sf.read(path, dtype="float32", always_2d=True)[0].astype(np.float16)
+            for name, path in stems.items()}
+
+
+def mix_and_export(stems, voice_vol, music_vol, bg_vol, wind_red, out_wav,
+                   arrays=None, denoise_cache=None, mixer=None, out=None):
     """
     Mix stems with given volume multipliers.
     voice_vol, music_vol, bg_vol: 0.0–2.0
     wind_red: 0–100 (reduction strength applied to the other/background stem)
+    arrays: stems already in memory (from load_stems); read from disk otherwise
+    denoise_cache: dict reused across calls; holds the background's noise
+        profile under "noise" and denoised backgrounds keyed by wind_red
+        rounded to 1%
+    mixer: block kernel from make_mixer; the generic _mix_block otherwise
+    out: reusable float32 mix buffer (see mix_stream)
     """
-    other_path = stems["other"]
-
-    if wind_red > 0:
-        nr_val = min(wind_red * 0.97, 97.0)
-        cleaned = os.path.join(tmp_dir, "other_clean.wav")
-        _ffmpeg("-i", other_path,
-                "-af", f"afftdn=nr={nr_val:.1f}:nf=-25",
-                cleaned)
-        other_path = cleaned
-
-    def load(path):
-        data, sr = sf.read(path, dtype="float32")
-        return data, sr
-
-    v_data,  sr = load(stems["vocals"])
-    dr_data, _  = load(stems["drums"])
-    ba_data, _  = load(stems["bass"])
-    ot_data, _  = load(other_path)
-
-    n = min(len(v_data), len(dr_data), len(ba_data), len(ot_data))
-    mixed = (
-        v_data[:n]  * voice_vol +
-        dr_data[:n] * music_vol +
-        ba_data[:n] * music_vol +
-        ot_data[:n] * bg_vol
-    )
+    with ExitStack() as stack:
+        if arrays is not None:
+            sources = [arrays[name] for name in STEMS]
+            sr = sf.info(stems["vocals"]).samplerate
+        else:
+            sources = [stack.enter_context(sf.SoundFile(stems[name], "r")) for name in STEMS]
+            sr = sources[0].samplerate
+
+        k = int(round(wind_red))
+        if k > 0:
+            cache = denoise_cache if denoise_cache is not None else {}
+            if k in cache:
+                sources[3] = cache[k]
+            else:
+                if "noise" not in cache:
+                    cache["noise"] = noise_profile(
+                        arrays["other"] if arrays is not None else stems["other"])
+                strength = min(k, 100) / 100
+                sources[3] = _denoise_blocks(_blocks(sources[3]), cache["noise"],
+                                             strength, floor=0.3 - 0.25 * strength)
+                if denoise_cache is not None and arrays is not None:
+                    # Keep a copy (in the stems' dtype) for the next call.
+                    kept, filled = np.empty_like(arrays["other"]), [0]
+                    sources[3] = _collect(sources[3], kept, filled)
+
+        mix_stream(sources, (voice_vol, music_vol, bg_vol), out_wav, sr, mixer, out)
+
+    # Only a copy the mix ran all the way through is complete.
+    if k > 0 and denoise_cache is not None and arrays is not None \
+            and k not in denoise_cache and filled[0] == len(kept):
+        while sum(key != "noise" for key in denoise_cache) >= DENOISE_CACHE_SIZE:
+            denoise_cache.pop(next(key for key in denoise_cache if key != "noise"))
+        denoise_cache[k] = kept
+
+
+def mix_stream(sources, gains, out_wav, sr, mixer=None, out=None):
+    """
+    Mix vocals/drums/bass/other sources (open SoundFiles or (frames, channels)
+    arrays) with (voice, music, background) gains into a float WAV, block by
+    block, peak-normalizing if the mix clips.
+    out: optional float32 (frames, channels) buffer, at least as long as the
+    shortest source, to mix into and reuse across calls instead of streaming.
+    """
+    mixer = mixer or _mix_block
+    gv, gm, gb = (np.float32(g) for g in gains)
+    first = sources[0]
+    channels = first.shape[1] if isinstance(first, np.ndarray) else first.channels
+
+    peak = 0.0
+    if out is not None:
+        pos = 0
+        for blocks in zip(*[_blocks(src) for src in sources]):
+            n = min(len(b) for b in blocks)
+            v, dr, ba, ot = (b[:n] for b in blocks)
+            peak = max(peak, mixer(v, dr, ba, ot, gv, gm, gb, out[pos:pos + n]))
+            pos += n
+        mixed = out[:pos]
+        if peak > 1.0:
+            mixed *= np.float32(1.0 / peak)
+        sf.write(out_wav, mixed, sr, subtype="FLOAT")
+        return
+
+    with sf.SoundFile(out_wav, "w", sr, channels, "FLOAT") as f:
+        for blocks in zip(*[_blocks(src) for src in sources]):
+            n = min(len(b) for b in blocks)
+            v, dr, ba, ot = (b[:n] for b in blocks)
+            mixed = np.empty((n, channels), dtype=np.float32)
+            peak = max(peak, mixer(v, dr, ba, ot, gv, gm, gb, mixed))
+            f.write(mixed)
 
-    peak = np.max(np.abs(mixed))
     if peak > 1.0:
-        mixed /= peak
+        _rescale(out_wav, 1.0 / peak)
+
 
-    sf.write(out_wav, mixed, sr)
+def _rescale(path, gain):
+    """Scale a float WAV in place, one block at a time."""
+    with sf.SoundFile(path, "r+") as f:
+        pos = 0
+        while pos < f.frames:
+            f.seek(pos)
+            block = f.read(BLOCK_FRAMES, dtype="float32", always_2d=True)
+            f.seek(pos)
+            f.write(block * gain)
+            pos += len(block)
 
 
 def mux_video(input_video, mixed_wav, output_path):
+    # Video is copied and the mix encoded in the same pass. The container
+    # follows output_path; MP4-family outputs get AAC with the moov atom up
+    # front so the download can start playing immediately, other containers
+    # keep ffmpeg's default audio codec for them (e.g. Opus in WebM).
+    audio = ["-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart"] \
+        if Path(output_path).suffix.lower() in MP4_EXTS else []
     _ffmpeg(
         "-i", input_video, "-i", mixed_wav,
-        "-c:v", "copy", "-map", "0:v:0", "-map", "1:a:0",
-        "-shortest", output_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-c:v", "copy", *audio, "-shortest", output_path,
     )
@@ -0,0 +1,149 @@
+"""End-to-end checks of the web app's routes, with separation faked out."""
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+SR = 8000
+FRAMES = 20000
+
+
+def fake_separate_job(job_id, input_path, job_dir, device, fast_mode=True):
+    """Stand-in for separate_job: write four noise stems into job_dir."""
+    rng = np.random.default_rng(0)
+    stems = {}
+    for name in ("vocals", "drums", "bass", "other"):
+        stems[name] = os.path.join(job_dir, f"{name}.wav")
+        sf.write(stems[name], 0.2 * rng.standard_normal((FRAMES, 2)), SR, subtype="FLOAT")
+    return stems
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    """src.app run from tmp_path, with a thread pool in place of the process pool."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "jobs").mkdir()
+    from src import app as app_module
+
+    monkeypatch.setattr(app_module, "executor", ThreadPoolExecutor(app_module.MAX_WORKERS))
+    return app_module
+
+
+@pytest.fixture
+def warmed(app_module, monkeypatch):
+    """Devices warm_model was called with; the real one would load htdemucs."""
+    calls = []
+    monkeypatch.setattr(app_module, "warm_model", calls.append)
+    return calls
+
+
+@pytest.fixture
+def client(app_module, monkeypatch, warmed):
+    monkeypatch.setattr(app_module, "separate_job", fake_separate_job)
+    with TestClient(app_module.app) as c:
+        yield c
+
+
+def wait_ready(app_module, job_id, timeout=60):
+    jobs = app_module.jobs
+    deadline = time.monotonic() + timeout
+    while jobs[job_id]["status"] == "processing":
+        assert time.monotonic() < deadline, "job never finished"
+        time.sleep(0.05)
+    assert jobs[job_id]["status"] == "ready", jobs[job_id]["message"]
+
+
+def test_startup_warms_every_worker(app_module, client, warmed):
+    deadline = time.monotonic() + 10
+    while len(warmed) < app_module.MAX_WORKERS:
+        assert time.monotonic() < deadline, "workers were not warmed"
+        time.sleep(0.01)
+    assert warmed == [app_module.DEFAULT_DEVICE] * app_module.MAX_WORKERS
+
+
+def test_startup_logs_warm_up_failure(app_module, monkeypatch, caplog):
+    def broken(device):
+        raise RuntimeError("no weights")
+    monkeypatch.setattr(app_module, "warm_model", broken)
+    with TestClient(app_module.app):
+        deadline = time.monotonic() + 10
+        while not app_module.app.state.warm_task.done():
+            assert time.monotonic() < deadline, "warm-up never finished"
+            time.sleep(0.01)
+    failures = [r for r in caplog.records if "Could not preload" in r.getMessage()]
+    assert len(failures) == app_module.MAX_WORKERS
+    assert "no weights" in str(failures[0].exc_info[1])
+
+
+def test_upload_preview_download(app_module, client):
+    upload = io.BytesIO()
+    sf.write(upload, np.zeros((FRAMES, 2)), SR, format="WAV")
+    r = client.post("/api/upload", files={"file": ("clip.wav", upload.getvalue())})
+    assert r.status_code == 200
+    job_id = r.json()["job_id"]
+
+    assert client.get(f"/api/download/{job_id}").status_code == 404
+
+    assert client.post(f"/api/process/{job_id}", json={}).status_code == 200
+    wait_ready(app_module, job_id)
+
+    for wind in (0, 40):
+        r = client.post(f"/api/preview/{job_id}", json={"voice": 50, "wind_reduction": wind})
+        assert r.status_code == 200
+        preview = client.get(r.json()["preview_url"])
+        assert preview.status_code == 200
+        assert sf.info(io.BytesIO(preview.content)).frames == FRAMES
+
+    r = client.get(f"/api/download/{job_id}")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "audio/wav"
+    assert "output.wav" in r.headers["content-disposition"]
+    mixed, sr = sf.read(io.BytesIO(r.content), dtype="float32")
+    assert sr == SR and mixed.shape == (FRAMES, 2)
+    assert np.isfinite(mixed).all() and np.abs(mixed).max() <= 1.0
+
+
+def test_broken_pool_is_replaced_and_warmed(app_module, client, warmed, monkeypatch):
+    from concurrent.futures.process import BrokenProcessPool
+
+    def crash(*args):
+        raise BrokenProcessPool("worker died")
+    monkeypatch.setattr(app_module, "separate_job", crash)
+    monkeypatch.setattr(app_module, "_make_executor",
+                        lambda: ThreadPoolExecutor(app_module.MAX_WORKERS))
+    old = app_module.executor
+    job_id = client.post("/api/upload", files={"file": ("clip.wav", b"x")}).json()["job_id"]
+    client.post(f"/api/process/{job_id}", json={})
+
+    deadline = time.monotonic() + 10
+    while app_module.jobs[job_id]["status"] == "processing" or len(warmed) < 2 * app_module.MAX_WORKERS:
+        assert time.monotonic() < deadline, "pool was not replaced and warmed"
+        time.sleep(0.01)
+    assert app_module.jobs[job_id]["status"] == "error"
+    assert app_module.executor is not old
+    app_module.executor.shutdown()
+
+
+def test_evicted_job_reloads_its_stems(app_module, client, monkeypatch):
+    monkeypatch.setattr(app_module, "RESIDENT_JOBS", 1)
+    ids = []
+    for _ in range(2):
+        job_id = client.post("/api/upload", files={"file": ("clip.wav", b"x")}).json()["job_id"]
+        client.post(f"/api/process/{job_id}", json={})
+        wait_ready(app_module, job_id)
+        ids.append(job_id)
+
+    for job_id in ids + ids[:1]:
+        r = client.post(f"/api/preview/{job_id}", json={"wind_reduction": 30})
+        assert r.status_code == 200
+        assert list(app_module.resident) == [job_id]
+        assert [("arrays" in app_module.jobs[i]) for i in ids] == [i == job_id for i in ids]
@@ -0,0 +1,148 @@
+"""Checks for src/separator.py on small synthetic inputs; no model download needed."""
+from fractions import Fraction
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from src import separator as sep
+
+th = pytest.importorskip("torch")
+pytest.importorskip("demucs")
+
+from demucs.apply import BagOfModels, apply_model  # noqa: E402
+from demucs.htdemucs import HTDemucs  # noqa: E402
+
+SR = 8000
+
+
+def tiny_htdemucs(seed=0):
+    """A randomly initialised HTDemucs small enough to run in milliseconds."""
+    th.manual_seed(seed)
+    return HTDemucs(list(sep.STEMS), audio_channels=2, samplerate=SR, segment=Fraction(1, 2),
+                    channels=4, depth=2, nfft=512, t_layers=1, t_heads=1,
+                    bottom_channels=0, dconv_mode=0, t_hidden_scale=1.0).eval()
+
+
+@pytest.mark.parametrize("length", [1500, 4000, 9000, 10001])
+def test_apply_vectorized_matches_apply_model(length):
+    model = tiny_htdemucs()
+    mix = th.randn(2, length, generator=th.Generator().manual_seed(length))
+    with th.no_grad():
+        ref = apply_model(model, mix[None], shifts=0, overlap=0.25, progress=False)[0]
+    calls = []
+    got = sep.apply_vectorized(model, mix, overlap=0.25, batch_size=3, callback=calls.append)
+    assert got.shape == ref.shape
+    assert th.allclose(got, ref, atol=1e-6)
+    assert calls[-1] == {"state": len(calls), "total": len(calls)}
+
+
+def test_apply_vectorized_bag_of_models():
+    bag = BagOfModels([tiny_htdemucs(0), tiny_htdemucs(1)], weights=[[1, 2, 1, 1], [1, 0, 1, 3]])
+    mix = th.randn(2, 6000, generator=th.Generator().manual_seed(0))
+    with th.no_grad():
+        ref = apply_model(bag, mix[None], shifts=0, overlap=0.25, progress=False)[0]
+    assert th.allclose(sep.apply_vectorized(bag, mix, overlap=0.25), ref, atol=1e-6)
+
+
+@pytest.mark.skipif(not th.cuda.is_available(), reason="needs CUDA")
+def test_apply_vectorized_fp16_cuda():
+    model = tiny_htdemucs().cuda()
+    mix = th.randn(2, 9000, generator=th.Generator().manual_seed(0))
+    with th.no_grad():
+        ref = apply_model(model, mix[None], shifts=0, overlap=0.25, progress=False,
+                          device="cuda")[0].cpu()
+    got = sep.apply_vectorized(model, mix, overlap=0.25)
+    assert got.device.type == "cpu"
+    assert th.allclose(got, ref, atol=1e-2)
+
+
+def test_infer_demucs_silent_input(monkeypatch):
+    monkeypatch.setattr(sep, "_get_model", lambda device: tiny_htdemucs())
+    arrays, sr = sep.infer_demucs(th.zeros(2, 5000))
+    assert sr == SR
+    assert all(np.isfinite(a).all() and a.shape == (5000, 2) for a in arrays.values())
+
+
+def noise(frames, channels=2, seed=0):
+    return np.random.default_rng(seed).standard_normal((frames, channels)).astype(np.float32)
+
+
+def chunks(x, sizes):
+    """Split x into consecutive blocks of the given sizes, cycling, until exhausted."""
+    pos, i = 0, 0
+    while pos < len(x):
+        n = sizes[i % len(sizes)]
+        yield x[pos:pos + n]
+        pos, i = pos + n, i + 1
+
+
+@pytest.mark.parametrize("sizes", [[sep.BLOCK_FRAMES], [1000], [100, 4096, 7]])
+def test_denoise_round_trip(sizes):
+    # At zero strength every gain is 1, so the STFT/overlap-add is an identity.
+    x = noise(30011)
+    out = list(sep._denoise_blocks(chunks(x, sizes), np.zeros((2, sep.STFT_SIZE // 2 + 1)), 0.0))
+    assert [len(b) for b in out] == [len(b) for b in chunks(x, sizes)]
+    np.testing.assert_allclose(np.concatenate(out), x, atol=1e-5)
+
+
+def test_denoise_independent_of_block_size():
+    x = noise(30011) * np.linspace(0, 1, 30011, dtype=np.float32)[:, None]
+    profile = sep.noise_profile(x)
+    runs = [np.concatenate(list(sep._denoise_blocks(chunks(x, sizes), profile, 0.8, 0.1)))
+            for sizes in ([sep.BLOCK_FRAMES], [333, 5000])]
+    np.testing.assert_allclose(runs[0], runs[1], atol=1e-5)
+    assert np.abs(runs[0]).sum() < np.abs(x).sum()
+
+
+def test_noise_profile_matches_full_stft(tmp_path):
+    # Per bin: the mean of that bin's lowest-power 10% of frames.
+    x = noise(40000) * np.linspace(0.01, 1, 40000, dtype=np.float32)[:, None]
+    half = sep.STFT_SIZE // 2
+    expected = []
+    for c in range(2):
+        xp = np.pad(x[:, c], (half, half + -len(x) % sep.STFT_HOP))
+        frames = np.lib.stride_tricks.sliding_window_view(xp, sep.STFT_SIZE)[::sep.STFT_HOP]
+        P = np.abs(np.fft.rfft(frames * sep._STFT_WINDOW, axis=-1)) ** 2
+        k = max(1, len(P) // 10)
+        expected.append(np.sort(P, axis=0)[:k].mean(axis=0))
+    np.testing.assert_allclose(sep.noise_profile(x), expected, rtol=1e-4)
+
+    sf.write(tmp_path / "x.wav", x, SR, subtype="FLOAT")
+    np.testing.assert_allclose(sep.noise_profile(str(tmp_path / "x.wav")), expected, rtol=1e-4)
+
+
+@pytest.mark.parametrize("use_out", [False, True])
+@pytest.mark.parametrize("gain", [0.1, 2.0])
+def test_mix_stream_peak_normalization(tmp_path, use_out, gain):
+    frames = 2 * sep.BLOCK_FRAMES + 123
+    sources = [noise(frames, seed=i) for i in range(4)]
+    out = np.empty((frames + 10, 2), dtype=np.float32) if use_out else None
+    sep.mix_stream(sources, (gain, gain, gain), tmp_path / "mix.wav", SR, out=out)
+
+    mixed, sr = sf.read(tmp_path / "mix.wav", dtype="float32")
+    expected = gain * sum(sources)
+    if np.abs(expected).max() > 1:
+        expected /= np.abs(expected).max()
+    assert sr == SR and mixed.shape == (frames, 2)
+    np.testing.assert_allclose(mixed, expected, atol=1e-5)
+
+
+def test_mix_and_export_float16_arrays(tmp_path):
+    frames = sep.BLOCK_FRAMES + 500
+    stems = {}
+    for i, name in enumerate(sep.STEMS):
+        stems[name] = str(tmp_path / f"{name}.wav")
+        sf.write(stems[name], 0.2 * noise(frames, seed=i), SR, subtype="FLOAT")
+    arrays = sep.load_stems(stems)
+    assert all(a.dtype == np.float16 for a in arrays.values())
+
+    cache = {}
+    for wind in (0, 40, 40):
+        sep.mix_and_export(stems, 1.0, 0.5, 1.5, wind, tmp_path / "disk.wav")
+        sep.mix_and_export(stems, 1.0, 0.5, 1.5, wind, tmp_path / "mem.wav", arrays=arrays,
+                           denoise_cache=cache, mixer=sep.make_mixer(2),
+                           out=np.empty((frames, 2), dtype=np.float32))
+        disk, mem = (sf.read(tmp_path / f, dtype="float32")[0] for f in ("disk.wav", "mem.wav"))
+        np.testing.assert_allclose(mem, disk, atol=2e-3)
+    assert 40 in cache and cache[40].dtype == np.float16